@@ -1,6 +1,8 @@
 import pickle
-import json
 import os
+import orjson
+import numpy as np
+import pandas as pd
 from pathlib import Path
 
 # 경로 설정
@@ -10,10 +12,21 @@ from pathlib import Path
 
 data_path = Path(r"c:\NAIS\data\tag_cache.pkl")
 output_path = Path(r"c:\NAIS\NAIS2\src\assets\tags.json")
+# 첫 변환 때 pickle을 배열로 풀어 저장해두는 캐시 (pickle이 더 새로우면 다시 생성)
+cache_path = data_path.with_suffix('.npz')
+
+# (pickle 키, 태그 타입) - 순서가 동률일 때의 정렬 순서
+sources = [
+    ('limited_generals', 'general'),
+    ('artist_dict', 'artist'),
+    ('character_dict_count', 'character'),
+    ('copyright_dict', 'copyright'),
+]
+tag_types = [tag_type for _, tag_type in sources]
 
 print(f"Looking for data at: {data_path}")
 
-if not data_path.exists():
+if not data_path.exists() and not cache_path.exists():
     print(f"Error: {data_path} not found.")
     # 더미 데이터 생성 (테스트용)
     dummy_tags = [
@@ -26,47 +39,73 @@ if not data_path.exists():
         {"label": "character:miku", "value": "character:miku", "count": 33333, "type": "character"}
     ]
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(dummy_tags, f, ensure_ascii=False)
+    output_path.write_bytes(orjson.dumps(dummy_tags))
     print(f"Created dummy tags at {output_path} because source was missing.")
     exit(0)
 
-try:
+def build_cache():
+    """pickle의 카테고리별 dict를 (label_bytes, label_offsets, counts, types) 배열로 변환해 저장"""
     with open(data_path, 'rb') as f:
         data = pickle.load(f)
-        
-    tags = []
     
-    # General
     # data['limited_generals']는 { 'tag': count, ... }
-    for tag, count in data.get('limited_generals', {}).items():
-        tags.append({"label": tag, "value": tag, "count": count, "type": "general"})
-        
-    # Artist
-    for tag, count in data.get('artist_dict', {}).items():
-        tags.append({"label": tag, "value": tag, "count": count, "type": "artist"})
-        
-    # Character
-    for tag, count in data.get('character_dict_count', {}).items():
-        tags.append({"label": tag, "value": tag, "count": count, "type": "character"})
+    encoded, counts, types = [], [], []
+    for type_id, (key, _) in enumerate(sources):
+        d = data.get(key, {})
+        encoded.extend(tag.encode('utf-8') for tag in d.keys())
+        counts.append(np.fromiter(d.values(), dtype=np.int64, count=len(d)))
+        types.append(np.full(len(d), type_id, dtype=np.int8))
+    
+    # 라벨은 UTF-8 바이트를 이어붙이고 오프셋으로 구분 (object 배열 없이 저장/로드)
+    label_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=label_offsets[1:])
+    arrays = {
+        "label_bytes": np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        "label_offsets": label_offsets,
+        "counts": np.concatenate(counts),
+        "types": np.concatenate(types),
+    }
+    # 압축하지 않아야 로드가 단순 읽기로 끝남
+    # 임시 파일에 쓴 뒤 교체해야 중단되어도 깨진 캐시가 남지 않음
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, cache_path)
+    print(f"Cached tag arrays to {cache_path}")
+    return arrays
 
-    # Copyright
-    for tag, count in data.get('copyright_dict', {}).items():
-        tags.append({"label": tag, "value": tag, "count": count, "type": "copyright"})
-        
-    # 빈도순 정렬
-    tags.sort(key=lambda x: x['count'], reverse=True)
+try:
+    if cache_path.exists() and (not data_path.exists() or cache_path.stat().st_mtime >= data_path.stat().st_mtime):
+        with np.load(cache_path) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+    else:
+        arrays = build_cache()
     
-    # 상위 30만개 저장 (성능과 커버리지 타협)
-    tags = tags[:300000]
+    label_bytes = arrays["label_bytes"].tobytes()
+    label_offsets = arrays["label_offsets"]
+    counts = arrays["counts"]
+    types = arrays["types"]
+
+    # 빈도순 상위 30만개 저장 (성능과 커버리지 타협)
+    # keep='first'로 동률일 때 기존 정렬(general > artist > character > copyright 순서)을 유지
+    # 개수 배열만으로 고르고, 라벨 문자열은 뽑힌 30만개만 디코딩
+    top = pd.Series(counts).nlargest(300000, keep='first').index.to_numpy()
     
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(tags, f, ensure_ascii=False)
+    # 30만개 dict 리스트를 한 번에 만들지 않고 한 줄씩 스트리밍으로 기록
+    # orjson은 항상 UTF-8로 출력 (ensure_ascii=False와 동일)
+    with open(output_path, 'wb') as f:
+        f.write(b'[')
+        for n, i in enumerate(top):
+            if n:
+                f.write(b',')
+            label = label_bytes[label_offsets[i]:label_offsets[i + 1]].decode('utf-8')
+            f.write(orjson.dumps({"label": label, "value": label, "count": int(counts[i]), "type": tag_types[types[i]]}))
+        f.write(b']')
         
-    print(f"Success: Saved {len(tags)} tags to {output_path}")
+    print(f"Success: Saved {len(top)} tags to {output_path}")
     
 except Exception as e:
-    print(f"Error processing pickle: {e}")
+    print(f"Error processing tag data: {e}")
     exit(1)
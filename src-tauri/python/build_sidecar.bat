@@ -16,7 +16,7 @@ if errorlevel 1 (
 
 REM Check/Install dependencies
 echo [1/3] Installing/updating dependencies...
-pip install pyinstaller fastapi uvicorn pillow numpy onnxruntime pandas huggingface_hub rembg tqdm --quiet
+pip install pyinstaller fastapi uvicorn pillow numpy opencv-python-headless onnxruntime onnx pandas huggingface_hub rembg tqdm --quiet
 
 REM Check if pyinstaller is available
 pyinstaller --version >nul 2>&1
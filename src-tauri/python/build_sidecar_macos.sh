@@ -25,7 +25,7 @@ fi
 
 echo ""
 echo "[1/3] Installing/updating dependencies..."
-pip3 install pyinstaller fastapi uvicorn pillow numpy onnxruntime pandas huggingface_hub rembg tqdm --quiet
+pip3 install pyinstaller fastapi uvicorn pillow numpy opencv-python-headless onnxruntime onnx pandas huggingface_hub rembg tqdm --quiet
 
 # Check if pyinstaller is available
 if ! command -v pyinstaller &> /dev/null; then
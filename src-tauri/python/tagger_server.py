@@ -5,12 +5,16 @@ Background removal is handled via cloud API in the frontend.
 """
 import os
 import sys
+import glob
 import argparse
+import asyncio
 import uvicorn
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
+import cv2
 from PIL import Image
 import io
 import numpy as np
@@ -49,12 +53,19 @@ os.makedirs(APP_DATA_DIR, exist_ok=True)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global batch_queue, preprocess_executor
     try:
         load_model()  # Load WD tagger model only
     except Exception as e:
         print(f"Startup error: {e}")
-    yield
-    # Clean up if needed
+    preprocess_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+    batch_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_worker())
+    try:
+        yield
+    finally:
+        batch_task.cancel()
+        preprocess_executor.shutdown(wait=False)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -70,13 +81,258 @@ app.add_middleware(
 # Global model variables
 MODEL_REPO = "SmilingWolf/wd-v1-4-convnext-tagger-v2"
 MODEL_FILE = "model.onnx"
+MODEL_INT8_FILE = "model.int8.onnx"  # Generated once from MODEL_FILE on first load
+MODEL_FP16_FILE = "model.fp16.onnx"  # Generated once from MODEL_FILE on first load
+MODEL_PRECISION = "int8"  # int8 | fp16 | fp32, set with --precision
+# ORT tensor type -> numpy dtype for the persistent input/output buffers
+ORT_NUMPY_TYPES = {'tensor(float)': np.float32, 'tensor(float16)': np.float16, 'tensor(uint8)': np.uint8}
 TAGS_FILE = "selected_tags.csv"
+INPUT_SIZE = 448
+MAX_BATCH = 8  # Max /tag requests stacked into one inference
+BATCH_WINDOW = 0.005  # Seconds to wait for more requests after the first one arrives
+PREPROCESS_WORKERS = 4  # Decode/resize threads (cv2 and numpy release the GIL)
 model_session = None
-tags_df = None
+INPUT_BUF = None  # Persistent (MAX_BATCH, INPUT_SIZE, INPUT_SIZE, 3) model input, reused across batches
+OUT_BUF = None  # Persistent (MAX_BATCH, num_tags) model output, written by ORT via io_binding
+batch_queue = None  # (preprocessed image, Future) pairs consumed by batch_worker
+preprocess_executor = None
+model_binding = None
+# Requests per inference for the loaded model: MAX_BATCH, or 1 for the int8 variant, whose
+# DynamicQuantizeLinear nodes pick one scale per tensor - batching would let other uploads shift an image's scores
+batch_limit = MAX_BATCH
+# Held by run_batch; activate_model takes it to swap the session/buffers between batches
+model_lock = threading.Lock()
+TAG_NAMES = None  # selected_tags.csv 'name' column, indexed by model output position
+TAG_CATS = None  # selected_tags.csv 'category' column as int8 (0: general, 4: character, 9: rating)
 rembg_session = None
 
+def is_fresh(path: str, source_path: str) -> bool:
+    """True if the generated file at path exists and is not older than the file it was made from."""
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_path)
+
+def find_head_nodes(model_path: str) -> list:
+    """
+    Names of the classifier layer(s): the first MatMul/Gemm/Conv reached walking back from the outputs.
+    These stay FP32 so per-tag scores near the threshold aren't shifted by quantization error.
+    """
+    import onnx
+    
+    graph = onnx.load(model_path).graph
+    producers = {output: node for node in graph.node for output in node.output}
+    head, seen = [], set()
+    frontier = [output.name for output in graph.output]
+    while frontier:
+        node = producers.get(frontier.pop())
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node.op_type in ('MatMul', 'Gemm', 'Conv'):
+            if node.name:
+                head.append(node.name)
+            continue
+        frontier.extend(node.input)
+    return head
+
+def quantize_model(model_path: str) -> str:
+    """
+    Return the int8 variant of model_path, creating it on first use.
+    Dynamic quantization needs no calibration images; only the backbone's MatMul (ConvNeXt's pointwise
+    layers, the bulk of its weights/FLOPs) is quantized since ORT's ConvInteger is slower than FP32 Conv.
+    The classification head is kept FP32 (see find_head_nodes).
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    
+    int8_path = os.path.join(os.path.dirname(model_path), MODEL_INT8_FILE)
+    if is_fresh(int8_path, model_path):
+        return int8_path
+    
+    print("Quantizing model to int8 (one-time)...")
+    tmp_path = int8_path + ".tmp"
+    quantize_dynamic(model_path, tmp_path, op_types_to_quantize=['MatMul'], weight_type=QuantType.QInt8,
+                     nodes_to_exclude=find_head_nodes(model_path))
+    os.replace(tmp_path, int8_path)
+    return int8_path
+
+def convert_model_fp16(model_path: str) -> str:
+    """
+    Return the FP16 variant of model_path, creating it on first use.
+    Inputs/outputs become float16 too, so the batch buffers (and their memory traffic) are half size.
+    """
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+    
+    fp16_path = os.path.join(os.path.dirname(model_path), MODEL_FP16_FILE)
+    if is_fresh(fp16_path, model_path):
+        return fp16_path
+    
+    print("Converting model to FP16 (one-time)...")
+    tmp_path = fp16_path + ".tmp"
+    onnx.save(convert_float_to_float16(onnx.load(model_path), keep_io_types=False), tmp_path)
+    os.replace(tmp_path, fp16_path)
+    return fp16_path
+
+def variant_path(model_path: str) -> str:
+    """File holding the MODEL_PRECISION variant of the FP32 download (the download itself for fp32)."""
+    if MODEL_PRECISION == "int8":
+        return os.path.join(os.path.dirname(model_path), MODEL_INT8_FILE)
+    if MODEL_PRECISION == "fp16":
+        return os.path.join(os.path.dirname(model_path), MODEL_FP16_FILE)
+    return model_path
+
+def optimized_path(model_path: str) -> str:
+    """File optimize_model saves for model_path."""
+    return f"{os.path.splitext(model_path)[0]}.ort-{ort.__version__}.onnx"
+
+def conversion_failed_path(model_path: str) -> str:
+    """
+    Marker prepare_model leaves when the MODEL_PRECISION conversion of model_path fails, so it isn't
+    retried (and re-failed) at every startup. Tied to the onnxruntime version, so an app update retries.
+    """
+    return f"{variant_path(model_path)}.failed-ort-{ort.__version__}"
+
+def is_model_prepared(model_path: str) -> bool:
+    """True if prepare_model would only return cached files (no conversion work)."""
+    path = variant_path(model_path)
+    if is_fresh(conversion_failed_path(model_path), model_path):
+        path = model_path
+    return is_fresh(path, model_path) and is_fresh(optimized_path(path), path)
+
+def prepare_model(model_path: str) -> tuple:
+    """
+    Return (model file to load, whether it contains dynamic-quant nodes) for MODEL_PRECISION,
+    converting from the FP32 download if needed. Falls back to FP32 / unoptimized on failure.
+    """
+    dynamic_quant = False
+    failed_path = conversion_failed_path(model_path)
+    if is_fresh(failed_path, model_path):
+        print(f"{MODEL_PRECISION} conversion failed previously, using FP32 model")
+    else:
+        try:
+            if MODEL_PRECISION == "int8":
+                model_path = quantize_model(model_path)
+                dynamic_quant = True
+            elif MODEL_PRECISION == "fp16":
+                model_path = convert_model_fp16(model_path)
+        except Exception as e:
+            print(f"{MODEL_PRECISION} conversion failed, using FP32 model: {e}")
+            try:
+                with open(failed_path, 'w', encoding='utf-8') as f:
+                    f.write(str(e))
+            except OSError as marker_error:
+                print(f"Failed to write {failed_path}: {marker_error}")
+    try:
+        model_path = optimize_model(model_path)
+    except Exception as e:
+        print(f"Graph optimization failed, using unoptimized model: {e}")
+    return model_path, dynamic_quant
+
+def add_uint8_input(model_path: str) -> bytes:
+    """
+    Return model_path serialized with its image input changed to uint8 and a Cast to the original type
+    as the first node. Preprocessing then stays uint8 end to end (1/4 the bytes of FP32).
+    Done in memory only; optimize_model saves the result.
+    """
+    import onnx
+    from onnx import helper, TensorProto
+    
+    model = onnx.load(model_path)
+    graph = model.graph
+    image_input = graph.input[0]
+    tensor_type = image_input.type.tensor_type
+    if tensor_type.elem_type == TensorProto.UINT8:
+        return model.SerializeToString()
+    
+    print("Adding uint8 input to model...")
+    # Nodes that read the input now read the Cast output; the input keeps its name
+    cast_output = image_input.name + "_cast"
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == image_input.name:
+                node.input[i] = cast_output
+    graph.node.insert(0, helper.make_node("Cast", [image_input.name], [cast_output],
+                                          to=tensor_type.elem_type, name="uint8_input_cast"))
+    tensor_type.elem_type = TensorProto.UINT8
+    return model.SerializeToString()
+
+def optimize_model(model_path: str) -> str:
+    """
+    Return model_path with a uint8 input (see add_uint8_input) and ORT's offline graph optimizations
+    (constant folding, node fusions) applied, creating it on first use so they aren't redone at every startup.
+    This is the only file saved for the pair of steps.
+    Saved at ORT_ENABLE_EXTENDED; the hardware-specific layout passes of ORT_ENABLE_ALL still run at load.
+    """
+    opt_path = optimized_path(model_path)
+    if is_fresh(opt_path, model_path):
+        return opt_path
+    
+    print("Saving optimized model graph (one-time)...")
+    tmp_path = opt_path + ".tmp"
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_options.optimized_model_filepath = tmp_path
+    try:
+        model = add_uint8_input(model_path)
+    except Exception as e:
+        print(f"Adding uint8 input failed, keeping float input: {e}")
+        model = model_path
+    ort.InferenceSession(model, sess_options=sess_options, providers=['CPUExecutionProvider'])
+    del model
+    os.replace(tmp_path, opt_path)
+    
+    # Drop caches written by other onnxruntime versions (each is a full model copy)
+    for stale_path in glob.glob(f"{glob.escape(os.path.splitext(model_path)[0])}.ort-*.onnx"):
+        if stale_path != opt_path:
+            try:
+                os.remove(stale_path)
+            except OSError as e:
+                print(f"Failed to remove stale model cache {stale_path}: {e}")
+    return opt_path
+
+def create_session_options() -> ort.SessionOptions:
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # intra_op_num_threads stays 0: ORT detects physical cores itself (SMT, Apple Silicon, hybrid CPUs).
+    # The graph is a single chain, so one inter-op thread is enough.
+    sess_options.inter_op_num_threads = 1
+    # Keep worker threads spinning between ops for lower tail latency
+    sess_options.add_session_config_entry('session.intra_op.allow_spinning', '1')
+    # Flush denormals to zero so tiny activations don't hit the slow FP path
+    sess_options.add_session_config_entry('session.set_denormal_as_zero', '1')
+    return sess_options
+
+def activate_model(model_path: str, dynamic_quant: bool):
+    """Create a session for model_path and swap it in, with buffers matching its input/output types."""
+    global model_session, INPUT_BUF, OUT_BUF, model_binding, batch_limit
+    # Load ONNX Runtime (CPU only for lightweight build)
+    print(f"Loading ONNX model {os.path.basename(model_path)} with CPU execution provider...")
+    session = ort.InferenceSession(model_path, sess_options=create_session_options(),
+                                   providers=['CPUExecutionProvider'])
+    
+    # Persistent input/output buffers; run_batch binds their first n rows (no per-call output allocation).
+    # Dtypes follow the loaded model: uint8 input (see add_uint8_input), float16 output for the FP16 variant.
+    input_dtype = ORT_NUMPY_TYPES[session.get_inputs()[0].type]
+    output_dtype = ORT_NUMPY_TYPES[session.get_outputs()[0].type]
+    input_buf = np.empty((MAX_BATCH, INPUT_SIZE, INPUT_SIZE, 3), dtype=input_dtype)
+    out_buf = np.empty((MAX_BATCH, len(TAG_NAMES)), dtype=output_dtype)
+    
+    with model_lock:
+        model_session = session
+        INPUT_BUF = input_buf
+        OUT_BUF = out_buf
+        model_binding = session.io_binding()
+        batch_limit = 1 if dynamic_quant else MAX_BATCH
+
+def prepare_model_in_background(model_path: str):
+    """Run the one-time conversions off startup, then swap the prepared model in."""
+    try:
+        activate_model(*prepare_model(model_path))
+        print("Prepared model loaded.")
+    except Exception as e:
+        print(f"Model preparation failed, keeping FP32 model: {e}")
+
 def load_model():
-    global model_session, tags_df
+    global TAG_NAMES, TAG_CATS
     print(f"Loading model from {APP_DATA_DIR}...")
     
     model_path = os.path.join(APP_DATA_DIR, MODEL_FILE)
@@ -99,39 +355,114 @@ def load_model():
         finally:
             update_download_status("", 0, 0, "")
 
-    # Load ONNX Runtime (CPU only for lightweight build)
-    print("Loading ONNX model with CPU execution provider...")
-    model_session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
-    
     print("Loading tags...")
-    tags_df = pd.read_csv(tags_path)
+    # Keep only flat arrays; the DataFrame isn't needed after load
+    tags_df = pd.read_csv(tags_path, usecols=['name', 'category'])
+    TAG_NAMES = tags_df['name'].to_numpy()
+    TAG_CATS = tags_df['category'].to_numpy(np.int8)
+    del tags_df
+    
+    if is_model_prepared(model_path):
+        try:
+            activate_model(*prepare_model(model_path))
+        except Exception as e:
+            # e.g. a corrupt cached file; the FP32 download still works
+            print(f"Failed to load prepared model, using FP32 model: {e}")
+            activate_model(model_path, False)
+    else:
+        # Quantizing/optimizing takes a while and would hold up the port (and /health) during startup:
+        # serve the FP32 download now and switch once the prepared model is ready
+        activate_model(model_path, False)
+        threading.Thread(target=prepare_model_in_background, args=(model_path,), daemon=True).start()
     
     print("Initializing rembg session...")
     global rembg_session
     rembg_session = new_session("isnet-general-use") # Default model
     print("Models loaded successfully.")
 
-def preprocess_image(image: Image.Image, size=448):
-    # Resize and pad to square
-    image = image.convert('RGB')
-    w, h = image.size
+def decode_image(contents: bytes) -> np.ndarray:
+    # libjpeg/libpng decode straight into a contiguous BGR uint8 array (no PIL object graph).
+    # EXIF orientation is ignored, like the previous PIL path.
+    image = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError("Cannot decode image")
+    return image
+
+def preprocess_image(image: np.ndarray, size=INPUT_SIZE, dtype=np.uint8):
+    # image: BGR uint8 (cv2.imdecode output) - the model expects BGR, so no channel swap
+    # dtype: model input dtype (INPUT_BUF.dtype), so the canvas never needs a second cast
+    h, w = image.shape[:2]
     
     # Resize keeping aspect ratio
     target_dim = max(w, h)
     scale = size / target_dim
-    new_w, new_h = int(w * scale), int(h * scale)
-    image = image.resize((new_w, new_h), Image.Resampling.BICUBIC)
+    new_w, new_h = max(1, int(w * scale)), max(1, int(h * scale))
+    # INTER_AREA when shrinking approximates PIL's antialiased BICUBIC; INTER_CUBIC when enlarging
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    image = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
     
-    # Pad to square (white background)
-    new_img = Image.new("RGB", (size, size), (255, 255, 255))
-    new_img.paste(image, ((size - new_w) // 2, (size - new_h) // 2))
-    
-    # Normalize
-    img_np = np.array(new_img).astype(np.float32)
-    img_np = img_np[..., ::-1] # RGB to BGR
+    # Pad to square (white background): blit into a canvas of the model dtype (a plain copy for uint8).
+    # Only the margins are filled, so every pixel is written exactly once.
+    top = (size - new_h) // 2
+    left = (size - new_w) // 2
+    img_np = np.empty((size, size, 3), dtype=dtype)
+    img_np[:top] = 255
+    img_np[top + new_h:] = 255
+    img_np[top:top + new_h, :left] = 255
+    img_np[top:top + new_h, left + new_w:] = 255
+    img_np[top:top + new_h, left:left + new_w] = image
     
     return img_np
 
+def decode_and_preprocess(contents: bytes) -> np.ndarray:
+    return preprocess_image(decode_image(contents), dtype=INPUT_BUF.dtype)
+
+def run_batch(images: list) -> np.ndarray:
+    """Run one inference over up to MAX_BATCH preprocessed images; returns a copy of their probs."""
+    n = len(images)
+    with model_lock:
+        # casting='unsafe': images preprocessed just before a model swap may be float 0-255; converting
+        # them to the new uint8 input is exact
+        np.stack(images, out=INPUT_BUF[:n], casting='unsafe')
+        # Rows are contiguous, so the first n rows of each buffer start at its base pointer
+        model_binding.bind_input(model_session.get_inputs()[0].name, 'cpu', 0, INPUT_BUF.dtype,
+                                 (n,) + INPUT_BUF.shape[1:], INPUT_BUF.ctypes.data)
+        model_binding.bind_output(model_session.get_outputs()[0].name, 'cpu', 0, OUT_BUF.dtype,
+                                  (n,) + OUT_BUF.shape[1:], OUT_BUF.ctypes.data)
+        model_session.run_with_iobinding(model_binding)
+        # Copy out: the next batch reuses OUT_BUF while callers are still parsing
+        return OUT_BUF[:n].copy()
+
+async def batch_worker():
+    """Collect queued /tag requests for up to BATCH_WINDOW and run them as one batch of at most batch_limit."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        limit = batch_limit
+        # Give concurrent requests the window to join, then take what is queued.
+        # (Not wait_for(get()): on Python 3.11 it can swallow the cancel from lifespan shutdown.)
+        if batch_queue.qsize() < limit - 1:
+            await asyncio.sleep(BATCH_WINDOW)
+        while len(batch) < limit and not batch_queue.empty():
+            batch.append(batch_queue.get_nowait())
+        
+        try:
+            # Inference runs off the event loop; batches stay serialized since we await each one
+            probs = await loop.run_in_executor(None, run_batch, [img for img, _ in batch])
+            for (_, fut), p in zip(batch, probs):
+                if not fut.done():
+                    fut.set_result(p)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+async def submit(img_input: np.ndarray) -> np.ndarray:
+    """Queue a preprocessed image for batched inference and wait for its probs."""
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((img_input, fut))
+    return await fut
+
 @app.post("/tag")
 async def tag_image(file: UploadFile = File(...), threshold: float = 0.35):
     if model_session is None:
@@ -139,29 +470,22 @@ async def tag_image(file: UploadFile = File(...), threshold: float = 0.35):
     
     try:
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Preprocess
-        img_input = preprocess_image(image)
-        img_input = np.expand_dims(img_input, axis=0) # Batch dimension
-        
-        # Inference
-        input_name = model_session.get_inputs()[0].name
-        label_name = model_session.get_outputs()[0].name
-        probs = model_session.run([label_name], {input_name: img_input})[0]
         
-        # Parse results
-        probs = probs[0]
-        result_tags = []
+        # Decode + preprocess off the event loop
+        img_input = await asyncio.get_running_loop().run_in_executor(
+            preprocess_executor, decode_and_preprocess, contents)
         
-        for i, p in enumerate(probs):
-            if p >= threshold:
-                tag_name = tags_df.iloc[i]['name']
-                category = tags_df.iloc[i]['category'] # 0: general, 4: character, 9: rating
-                result_tags.append({"label": tag_name, "score": float(p), "category": int(category)})
+        # Inference (micro-batched with concurrent requests)
+        probs = await submit(img_input)
         
-        # Sort by score
-        result_tags.sort(key=lambda x: x['score'], reverse=True)
+        # Parse results: threshold + gather in NumPy, sorted by score (stable, like list.sort)
+        idx = np.flatnonzero(probs >= threshold)
+        scores = probs[idx]
+        order = np.argsort(-scores, kind='stable')
+        result_tags = [
+            {"label": TAG_NAMES[i], "score": float(p), "category": int(TAG_CATS[i])}
+            for i, p in zip(idx[order], scores[order])
+        ]
         
         return {"tags": result_tags}
         
@@ -178,11 +502,16 @@ async def remove_background(image: UploadFile = File(...)):
     
     try:
         contents = await image.read()
-        # rembg expects bytes or PIL image
-        output = remove(contents, session=rembg_session)
+        # Open with PIL like rembg's bytes path (EXIF orientation, source alpha and modes handled the same),
+        # but pass the image so rembg returns it instead of re-encoding its own PNG
+        cutout = remove(Image.open(io.BytesIO(contents)), session=rembg_session)
+        rgba = np.asarray(cutout.convert("RGBA"))
         
-        # Return as PNG
-        return Response(content=output, media_type="image/png")
+        # Return as WebP (much faster to encode than PNG; alpha stays lossless)
+        ok, buf = cv2.imencode(".webp", cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA), [cv2.IMWRITE_WEBP_QUALITY, 95])
+        if not ok:
+            raise ValueError("Failed to encode WebP")
+        return Response(content=buf.tobytes(), media_type="image/webp")
     except Exception as e:
         print(f"RMBG Error: {e}")
         return Response(content=str(e), status_code=500)
@@ -200,7 +529,10 @@ def health_check():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--precision", choices=["int8", "fp16", "fp32"], default=MODEL_PRECISION,
+                        help="Model variant to run (int8 and fp16 are converted from the FP32 download once)")
     args = parser.parse_args()
+    MODEL_PRECISION = args.precision
     
     # Run server
     uvicorn.run(app, host="127.0.0.1", port=args.port)
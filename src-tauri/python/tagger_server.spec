@@ -34,9 +34,13 @@ hiddenimports = [
     'uvicorn.lifespan',
     'uvicorn.lifespan.on',
     'onnxruntime',
+    'onnxruntime.quantization',
+    'onnxruntime.transformers.float16',
+    'onnx',
     'pandas',
     'PIL',
     'numpy',
+    'cv2',
     'huggingface_hub',
     'rembg',
     'scipy',